@@ -1,23 +1,31 @@
 import os
 import io
 import uuid
+import pickle
 import datetime
+import redis
 from flask import (
-    Flask, render_template, redirect, url_for, flash, request, send_file, abort, jsonify
+    Flask, render_template, redirect, url_for, flash, request, send_file, abort, jsonify, session
 )
+from flask_caching import Cache
+from markupsafe import Markup
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from werkzeug.utils import secure_filename
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload, make_transient_to_detached
 from PIL import Image
 from config import DevConfig, ProdConfig
 from forms import RegisterForm, LoginForm, UploadForm, ProfileForm, PlaylistForm, CommentForm
-from models import db, User, Track, Follow, Favorite, Comment, Playlist, PlaylistTrack
+from models import db, likes_table, password_hasher, User, Track, Follow, Favorite, Comment, Playlist, PlaylistTrack
 from utils import (
-    allowed_file, ensure_upload_folder,
+    allowed_file, ensure_upload_folder, search_tracks, insert_ignore,
     handle_avatar_upload, process_track_upload,
-    get_file_stream_response, storage_delete
+    get_file_stream_response, storage_delete, discard_spooled_upload
 )
+from tasks import celery_init_app, transcode_track
 
 # choose config
 ENV = os.environ.get("FLASK_ENV", "development")
@@ -31,26 +39,97 @@ db.init_app(app)
 migrate = Migrate(app, db)
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
+celery = celery_init_app(app)
+redis_client = redis.Redis.from_url(app.config["REDIS_URL"])
+cache = Cache(app)
 
 # ensure upload folder
 if app.config["STORAGE_MODE"] == "local":
     ensure_upload_folder(app.config["UPLOAD_FOLDER"])
 
+# columns kept out of the cached session user; they lazy-load if ever touched
+USER_CACHE_EXCLUDE = {"password_hash", "avatar_data"}
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    """Load current_user from redis when possible, saving a users SELECT per request."""
+    key = f"u:{user_id}"
+    try:
+        blob = redis_client.get(key)
+    except redis.RedisError:
+        app.logger.warning("user cache unavailable", exc_info=True)
+        blob = None
+    if blob is not None:
+        user = User(**pickle.loads(blob))
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+    user = User.query.get(int(user_id))
+    if user is not None:
+        data = {c.key: getattr(user, c.key) for c in User.__table__.columns if c.key not in USER_CACHE_EXCLUDE}
+        try:
+            redis_client.setex(key, app.config["USER_CACHE_TTL"], pickle.dumps(data))
+        except redis.RedisError:
+            app.logger.warning("user cache unavailable", exc_info=True)
+    return user
+
+def forget_cached_user(user_id):
+    try:
+        redis_client.delete(f"u:{user_id}")
+    except redis.RedisError:
+        app.logger.warning("user cache unavailable", exc_info=True)
+
+def bump_counter(column, row_id, delta):
+    """Add delta to a denormalised counter (Track.likes_count, User.followers_count) and return the new value."""
+    model = column.class_
+    stmt = update(model).where(model.id == row_id).values({column: column + delta}).returning(column)
+    return db.session.execute(stmt).scalar()
 
 @app.context_processor
 def inject_now():
     return {"now": datetime.datetime.utcnow()}
 
+def personalised_request():
+    # pages for logged-in users or carrying flash messages must not be shared through the cache
+    return current_user.is_authenticated or "_flashes" in session
+
+def track_comments_key(track_id):
+    return f"track_comments/{track_id}"
+
+def render_track_comments(track_id):
+    """Comments HTML for a track, cached for 60s. A cache outage only costs a re-render."""
+    key = track_comments_key(track_id)
+    try:
+        html = cache.get(key)
+    except redis.RedisError:
+        app.logger.warning("page cache unavailable", exc_info=True)
+        html = None
+    if html is None:
+        comments = (
+            Comment.query.options(selectinload(Comment.user))
+            .filter_by(track_id=track_id)
+            .order_by(Comment.created_at.asc())
+            .all()
+        )
+        html = render_template("track_comments.html", comments=comments)
+        try:
+            cache.set(key, html, timeout=60)
+        except redis.RedisError:
+            app.logger.warning("page cache unavailable", exc_info=True)
+    return Markup(html)
+
 @app.route("/")
+@cache.cached(timeout=30, query_string=True, unless=personalised_request)
 def index():
     page = request.args.get("page", 1, type=int)
     q = request.args.get("q", "").strip()
-    query = Track.query.filter(Track.is_public.is_(True)).order_by(Track.created_at.desc())
+    # owner is rendered on every card: load them in one extra query instead of one per track
+    query = (
+        Track.query.options(selectinload(Track.owner))
+        .filter(Track.is_public.is_(True))
+        .order_by(Track.created_at.desc())
+    )
     if q:
-        query = query.filter(Track.title.ilike(f"%{q}%"))
+        query = search_tracks(query, q)
     tracks = query.paginate(page=page, per_page=12)
     return render_template("index.html", tracks=tracks, q=q)
 
@@ -60,15 +139,24 @@ def register():
         return redirect(url_for("index"))
     form = RegisterForm()
     if form.validate_on_submit():
-        if User.query.filter_by(email=form.email.data).first():
+        # single INSERT ... ON CONFLICT (email) DO NOTHING RETURNING: no check-then-insert race
+        stmt = insert_ignore(
+            User, ["email"],
+            username=form.username.data,
+            email=form.email.data,
+            password_hash=password_hasher.hash(form.password.data),
+        ).returning(User)
+        try:
+            user = db.session.scalar(stmt)
+        except IntegrityError:
+            # the other unique column
+            db.session.rollback()
+            flash("Username already taken.", "warning")
+            return render_template("register.html", form=form)
+        if user is None:
+            db.session.rollback()
             flash("Email already registered.", "warning")
             return render_template("register.html", form=form)
-        user = User(
-            username=form.username.data,
-            email=form.email.data
-        )
-        user.set_password(form.password.data)
-        db.session.add(user)
         db.session.commit()
         login_user(user)
         flash("Welcome — your account is ready!", "success")
@@ -83,6 +171,7 @@ def login():
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
         if user and user.check_password(form.password.data):
+            db.session.commit()  # persists a rehashed password, if any
             login_user(user, remember=form.remember.data)
             flash("Logged in", "success")
             return redirect(request.args.get("next") or url_for("index"))
@@ -108,6 +197,7 @@ def profile(username):
             handle_avatar_upload(current_user, form.avatar.data, app)
         current_user.bio = form.bio.data
         db.session.commit()
+        forget_cached_user(current_user.id)
         flash("Profile updated", "success")
         return redirect(url_for("profile", username=current_user.username))
     tracks = Track.query.filter_by(owner_id=user.id).order_by(Track.created_at.desc()).all()
@@ -119,22 +209,28 @@ def follow(user_id):
     to_follow = User.query.get_or_404(user_id)
     if to_follow.id == current_user.id:
         return jsonify({"error": "cannot follow yourself"}), 400
-    if Follow.query.filter_by(follower_id=current_user.id, followed_id=to_follow.id).first():
+    result = db.session.execute(
+        insert_ignore(Follow.__table__, ["follower_id", "followed_id"], follower_id=current_user.id, followed_id=to_follow.id)
+    )
+    if not result.rowcount:
+        db.session.rollback()
         return jsonify({"status": "already_following"})
-    follow = Follow(follower_id=current_user.id, followed_id=to_follow.id)
-    db.session.add(follow)
+    count = bump_counter(User.followers_count, to_follow.id, 1)
     db.session.commit()
-    return jsonify({"status": "ok", "followers_count": to_follow.followers.count()})
+    return jsonify({"status": "ok", "followers_count": count})
 
 @app.route("/unfollow/<int:user_id>", methods=["POST"])
 @login_required
 def unfollow(user_id):
     to_unfollow = User.query.get_or_404(user_id)
-    follow = Follow.query.filter_by(follower_id=current_user.id, followed_id=to_unfollow.id).first()
-    if follow:
-        db.session.delete(follow)
-        db.session.commit()
-    return jsonify({"status": "ok", "followers_count": to_unfollow.followers.count()})
+    result = db.session.execute(
+        Follow.__table__.delete().where(Follow.follower_id == current_user.id, Follow.followed_id == to_unfollow.id)
+    )
+    count = to_unfollow.followers_count
+    if result.rowcount:
+        count = bump_counter(User.followers_count, to_unfollow.id, -1)
+    db.session.commit()
+    return jsonify({"status": "ok", "followers_count": count})
 
 @app.route("/upload", methods=["GET", "POST"])
 @login_required
@@ -168,21 +264,38 @@ def upload():
             thumbnail=thumbnail_filename  # save thumbnail filename in DB
         )
 
+        # no flush here: the row (and, in postgres mode, the original audio) is written once, on commit
         db.session.add(track)
-        db.session.flush()  # get id before committing
 
+        tmp_path = None
         try:
-            # process upload: store original + generate mp3 + preview clip
-            process_track_upload(track, f, app)
+            # store original now; mp3 + preview clip are generated by the worker
+            tmp_path = process_track_upload(track, f, app)
             db.session.commit()
-            flash("Upload successful — transcoding & previews created.", "success")
-            return redirect(url_for("track", track_id=track.id))
         except Exception as e:
             db.session.rollback()
             # cleanup any stored files if necessary
             storage_delete(track, app)
+            discard_spooled_upload(tmp_path, app)
             app.logger.exception("Upload failed")
             flash("Upload failed: " + str(e), "danger")
+            return render_template("upload.html", form=form)
+
+        # the track is committed from here on: a failed enqueue must not delete its stored original
+        try:
+            transcode_track.delay(
+                track.id, tmp_path,
+                app.config["TRANSCODE_BITRATE"], app.config["PREVIEW_DURATION"], app.config["PREVIEW_BITRATE"]
+            )
+        except Exception:
+            app.logger.exception("Could not queue transcode for track %s", track.id)
+            track.status = "failed"
+            db.session.commit()
+            discard_spooled_upload(tmp_path, app)
+            flash("Upload saved, but transcoding could not be started. The original file is playable.", "warning")
+            return redirect(url_for("track", track_id=track.id))
+        flash("Upload successful — transcoding & previews are on the way.", "success")
+        return redirect(url_for("track", track_id=track.id))
 
     return render_template("upload.html", form=form)
 
@@ -190,17 +303,18 @@ def upload():
 @app.route("/track/<int:track_id>")
 def track(track_id):
     track = Track.query.get_or_404(track_id)
-    comments = Comment.query.filter_by(track_id=track_id).order_by(Comment.created_at.asc()).all()
+    comments_html = render_track_comments(track.id)
     is_favorited = False
     if current_user.is_authenticated:
         is_favorited = Favorite.query.filter_by(user_id=current_user.id, track_id=track.id).first() is not None
-    return render_template("track.html", track=track, comments=comments, is_favorited=is_favorited, comment_form=CommentForm())
+    return render_template("track.html", track=track, comments_html=comments_html, is_favorited=is_favorited, comment_form=CommentForm())
 
 @app.route("/stream/<int:track_id>")
 def stream(track_id):
     """
-    Serve transcoded mp3 if available, else original. Supports streaming via send_file from memory/file.
-    For large-scale production use S3 signed URLs or proper file streaming with Range requests.
+    Serve transcoded mp3 once the track is ready, else the original. Range requests get 206
+    responses in every storage mode; in s3 mode the client is redirected to a presigned URL
+    (unless S3_PRESIGNED_URLS is off) and local files can be handed to nginx via X-Accel-Redirect.
     """
     track = Track.query.get_or_404(track_id)
     # prefer mp3_stream (transcoded) field if available
@@ -215,30 +329,39 @@ def preview(track_id):
 @login_required
 def like(track_id):
     track = Track.query.get_or_404(track_id)
-    if track.likes.filter_by(user_id=current_user.id).first():
+    result = db.session.execute(
+        insert_ignore(likes_table, ["user_id", "track_id"], user_id=current_user.id, track_id=track.id)
+    )
+    if not result.rowcount:
+        db.session.rollback()
         return jsonify({"status": "already_liked"})
-    track.likes.append(current_user)
+    count = bump_counter(Track.likes_count, track.id, 1)
     db.session.commit()
-    return jsonify({"status": "ok", "likes_count": track.likes.count()})
+    return jsonify({"status": "ok", "likes_count": count})
 
 @app.route("/unlike/<int:track_id>", methods=["POST"])
 @login_required
 def unlike(track_id):
     track = Track.query.get_or_404(track_id)
-    if track.likes.filter_by(user_id=current_user.id).first():
-        track.likes.remove(current_user)
-        db.session.commit()
-    return jsonify({"status": "ok", "likes_count": track.likes.count()})
+    result = db.session.execute(
+        likes_table.delete().where(likes_table.c.user_id == current_user.id, likes_table.c.track_id == track.id)
+    )
+    count = track.likes_count
+    if result.rowcount:
+        count = bump_counter(Track.likes_count, track.id, -1)
+    db.session.commit()
+    return jsonify({"status": "ok", "likes_count": count})
 
 @app.route("/favorite/<int:track_id>", methods=["POST"])
 @login_required
 def favorite(track_id):
     track = Track.query.get_or_404(track_id)
-    if Favorite.query.filter_by(user_id=current_user.id, track_id=track.id).first():
-        return jsonify({"status": "already_favorited"})
-    fav = Favorite(user_id=current_user.id, track_id=track.id)
-    db.session.add(fav)
+    result = db.session.execute(
+        insert_ignore(Favorite.__table__, ["user_id", "track_id"], user_id=current_user.id, track_id=track.id)
+    )
     db.session.commit()
+    if not result.rowcount:
+        return jsonify({"status": "already_favorited"})
     return jsonify({"status": "ok"})
 
 @app.route("/unfavorite/<int:track_id>", methods=["POST"])
@@ -259,6 +382,11 @@ def comment(track_id):
         c = Comment(track_id=track.id, user_id=current_user.id, body=form.body.data)
         db.session.add(c)
         db.session.commit()
+        try:
+            cache.delete(track_comments_key(track.id))
+        except redis.RedisError:
+            # the comment is saved; the cached list catches up within 60s
+            app.logger.warning("page cache unavailable", exc_info=True)
         return redirect(url_for("track", track_id=track_id) + "#comments")
     return redirect(url_for("track", track_id=track_id))
 
@@ -285,10 +413,10 @@ def playlist_add_track(playlist_id, track_id):
     p = Playlist.query.get_or_404(playlist_id)
     if p.user_id != current_user.id:
         abort(403)
-    if PlaylistTrack.query.filter_by(playlist_id=p.id, track_id=track_id).first() is None:
-        pt = PlaylistTrack(playlist_id=p.id, track_id=track_id)
-        db.session.add(pt)
-        db.session.commit()
+    db.session.execute(
+        insert_ignore(PlaylistTrack.__table__, ["playlist_id", "track_id"], playlist_id=p.id, track_id=track_id)
+    )
+    db.session.commit()
     return jsonify({"status": "ok"})
 
 @app.route("/search")
@@ -296,7 +424,8 @@ def search():
     q = request.args.get("q", "")
     tracks = []
     if q:
-        tracks = Track.query.filter(Track.title.ilike(f"%{q}%")).limit(20).all()
+        query = Track.query.options(selectinload(Track.owner))
+        tracks = search_tracks(query, q, rank=True).limit(20).all()
     return render_template("search.html", q=q, tracks=tracks)
 
 # simple user settings
@@ -309,6 +438,7 @@ def settings():
         if form.avatar.data:
             handle_avatar_upload(current_user, form.avatar.data, app)
         db.session.commit()
+        forget_cached_user(current_user.id)
         flash("Settings saved", "success")
         return redirect(url_for("profile", username=current_user.username))
     return render_template("settings.html", form=form)
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 
 BASE_DIR = Path(__file__).parent
@@ -15,22 +16,46 @@ class BaseConfig:
 
     # local storage
     UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", str(BASE_DIR / "uploads"))
+    # hand local files to nginx instead of streaming them through python; needs e.g.
+    #   location /internal_uploads/ { internal; alias /var/www/flask_music/uploads/; }
+    X_ACCEL_REDIRECT = os.environ.get("X_ACCEL_REDIRECT", "0") == "1"
+    X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX", "/internal_uploads/")
+
+    # size of the pieces audio is streamed in (postgres and s3 modes)
+    STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 256 * 1024))
 
     # s3 settings (only used if STORAGE_MODE == 's3')
     S3_BUCKET = os.environ.get("S3_BUCKET")
     S3_REGION = os.environ.get("S3_REGION")
     AWS_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID")
     AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
+    # redirect /stream and /preview to presigned S3 URLs instead of proxying the bytes
+    S3_PRESIGNED_URLS = os.environ.get("S3_PRESIGNED_URLS", "1") == "1"
+    S3_PRESIGN_EXPIRES = int(os.environ.get("S3_PRESIGN_EXPIRES", 3600))  # seconds
 
-    # ffmpeg/pydub settings
+    # ffmpeg settings
     PREVIEW_DURATION = int(os.environ.get("PREVIEW_DURATION", 30))  # preview length in seconds
     TRANSCODE_BITRATE = os.environ.get("TRANSCODE_BITRATE", "192k")
+    PREVIEW_BITRATE = os.environ.get("PREVIEW_BITRATE", "96k")  # previews are encoded mono
+
+    # background transcoding (celery worker, redis broker)
+    REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+    CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", REDIS_URL)
+    # page / fragment cache (flask-caching)
+    CACHE_TYPE = os.environ.get("CACHE_TYPE", "RedisCache")
+    CACHE_REDIS_URL = REDIS_URL
+    CACHE_DEFAULT_TIMEOUT = 60
+    USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", 300))  # seconds a logged-in user row is cached
+    # uploads are spooled here until the worker picks them up; must be shared with the workers
+    TRANSCODE_SPOOL_FOLDER = os.environ.get("TRANSCODE_SPOOL_FOLDER", str(Path(tempfile.gettempdir()) / "flask_music_spool"))
 
 class DevConfig(BaseConfig):
     DEBUG = True
     SQLALCHEMY_DATABASE_URI = os.environ.get(
         "DEV_DATABASE_URL", "sqlite:///" + str(BASE_DIR / "dev.db")
     )
+    # in-process cache: with DEBUG on, Flask-Caching re-raises backend errors instead of skipping the cache
+    CACHE_TYPE = os.environ.get("CACHE_TYPE", "SimpleCache")
 
 class ProdConfig(BaseConfig):
     DEBUG = False
@@ -0,0 +1,27 @@
+"""track status
+
+Revision ID: 5b1d7c2e9a41
+Revises: eec15a973979
+Create Date: 2025-08-20 14:12:05.481203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1d7c2e9a41'
+down_revision = 'eec15a973979'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing tracks were transcoded inline on upload, so they are already ready
+    with op.batch_alter_table('tracks', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('status', sa.String(length=20), nullable=False, server_default='ready'))
+
+
+def downgrade():
+    with op.batch_alter_table('tracks', schema=None) as batch_op:
+        batch_op.drop_column('status')
@@ -0,0 +1,60 @@
+"""composite indexes
+
+Revision ID: 9c3f4a8d2b17
+Revises: 5b1d7c2e9a41
+Create Date: 2025-08-21 09:40:12.116842
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c3f4a8d2b17'
+down_revision = '5b1d7c2e9a41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # drop duplicates left by the old check-then-insert handlers before adding unique constraints
+    op.execute(
+        "DELETE FROM follows WHERE id NOT IN "
+        "(SELECT MIN(id) FROM follows GROUP BY follower_id, followed_id)"
+    )
+    op.execute(
+        "DELETE FROM favorites WHERE id NOT IN "
+        "(SELECT MIN(id) FROM favorites GROUP BY user_id, track_id)"
+    )
+
+    with op.batch_alter_table('tracks', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_tracks_owner_id'))
+        batch_op.create_index('ix_tracks_owner_created', ['owner_id', 'created_at'], unique=False)
+        batch_op.create_index('ix_tracks_public_created', ['is_public', 'created_at'], unique=False)
+
+    with op.batch_alter_table('follows', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_follows_pair', ['follower_id', 'followed_id'])
+        batch_op.create_index('ix_follows_followed', ['followed_id'], unique=False)
+
+    with op.batch_alter_table('favorites', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_favorites_pair', ['user_id', 'track_id'])
+
+    with op.batch_alter_table('likes', schema=None) as batch_op:
+        batch_op.create_index('ix_likes_track_user', ['track_id', 'user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('likes', schema=None) as batch_op:
+        batch_op.drop_index('ix_likes_track_user')
+
+    with op.batch_alter_table('favorites', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_favorites_pair', type_='unique')
+
+    with op.batch_alter_table('follows', schema=None) as batch_op:
+        batch_op.drop_index('ix_follows_followed')
+        batch_op.drop_constraint('uq_follows_pair', type_='unique')
+
+    with op.batch_alter_table('tracks', schema=None) as batch_op:
+        batch_op.drop_index('ix_tracks_public_created')
+        batch_op.drop_index('ix_tracks_owner_created')
+        batch_op.create_index(batch_op.f('ix_tracks_owner_id'), ['owner_id'], unique=False)
@@ -0,0 +1,32 @@
+"""track full-text index
+
+Revision ID: d47e0b6a1c95
+Revises: 9c3f4a8d2b17
+Create Date: 2025-08-22 16:03:47.902315
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd47e0b6a1c95'
+down_revision = '9c3f4a8d2b17'
+branch_labels = None
+depends_on = None
+
+# must match models.track_search_document
+SEARCH_DOCUMENT = "to_tsvector('english', coalesce(title, '') || ' ' || coalesce(description, ''))"
+
+
+def upgrade():
+    # postgres only; sqlite dev databases keep using ILIKE
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.create_index('ix_tracks_fts', 'tracks', [sa.text(SEARCH_DOCUMENT)], unique=False, postgresql_using='gin')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_tracks_fts', table_name='tracks')
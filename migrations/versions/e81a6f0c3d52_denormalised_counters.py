@@ -0,0 +1,42 @@
+"""denormalised like / follower counters
+
+Revision ID: e81a6f0c3d52
+Revises: d47e0b6a1c95
+Create Date: 2025-08-25 11:18:30.664019
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e81a6f0c3d52'
+down_revision = 'd47e0b6a1c95'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('tracks', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('likes_count', sa.Integer(), nullable=False, server_default='0'))
+
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('followers_count', sa.Integer(), nullable=False, server_default='0'))
+
+    # backfill from the existing join tables
+    op.execute(
+        "UPDATE tracks SET likes_count = "
+        "(SELECT COUNT(*) FROM likes WHERE likes.track_id = tracks.id)"
+    )
+    op.execute(
+        "UPDATE users SET followers_count = "
+        "(SELECT COUNT(*) FROM follows WHERE follows.followed_id = users.id)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_column('followers_count')
+
+    with op.batch_alter_table('tracks', schema=None) as batch_op:
+        batch_op.drop_column('likes_count')
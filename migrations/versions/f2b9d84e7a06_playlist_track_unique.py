@@ -0,0 +1,31 @@
+"""unique playlist track pairs
+
+Revision ID: f2b9d84e7a06
+Revises: e81a6f0c3d52
+Create Date: 2025-08-26 10:05:51.237448
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b9d84e7a06'
+down_revision = 'e81a6f0c3d52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # drop duplicates left by the old check-then-insert handler before adding the constraint
+    op.execute(
+        "DELETE FROM playlist_tracks WHERE id NOT IN "
+        "(SELECT MIN(id) FROM playlist_tracks GROUP BY playlist_id, track_id)"
+    )
+    with op.batch_alter_table('playlist_tracks', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_playlist_tracks_pair', ['playlist_id', 'track_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('playlist_tracks', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_playlist_tracks_pair', type_='unique')
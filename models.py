@@ -1,17 +1,24 @@
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import Table, Column, Integer, ForeignKey, LargeBinary, Text
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from sqlalchemy import Table, Column, Integer, ForeignKey, LargeBinary, Text, func, literal_column
 from sqlalchemy.orm import relationship
 
 db = SQLAlchemy()
 
+# argon2id; ~64 MiB and two passes per hash keeps a login well under werkzeug's pbkdf2 CPU cost
+password_hasher = PasswordHasher(time_cost=2, memory_cost=65536, parallelism=2)
+
 # many-to-many for likes (user <-> track)
 likes_table = db.Table(
     "likes",
     db.Column("user_id", db.Integer, db.ForeignKey("users.id"), primary_key=True),
     db.Column("track_id", db.Integer, db.ForeignKey("tracks.id"), primary_key=True),
+    # the primary key leads with user_id; per-track lookups (counts) need track_id first
+    db.Index("ix_likes_track_user", "track_id", "user_id"),
 )
 
 class User(UserMixin, db.Model):
@@ -22,11 +29,14 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(255), nullable=False)
     bio = db.Column(db.Text, default="")
     avatar_filename = db.Column(db.String(255), nullable=True)
-    avatar_data = db.Column(db.LargeBinary, nullable=True)  # optional store avatar bytes in db
+    avatar_data = db.deferred(db.Column(db.LargeBinary, nullable=True))  # optional store avatar bytes in db
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # denormalised count of follows rows pointing at this user, kept in step by follow/unfollow
+    followers_count = db.Column(db.Integer, default=0, nullable=False)
 
+    # collections that can grow without bound stay dynamic; small ones load as plain lists
     tracks = db.relationship("Track", backref="owner", lazy="dynamic")
-    playlists = db.relationship("Playlist", backref="owner", lazy="dynamic")
+    playlists = db.relationship("Playlist", backref="owner")
 
     # followers/following (self-referential)
     following = db.relationship(
@@ -44,18 +54,34 @@ class User(UserMixin, db.Model):
         cascade="all, delete-orphan",
     )
 
-    favorites = db.relationship("Favorite", backref="user", lazy="dynamic")
+    favorites = db.relationship("Favorite", backref="user")
 
     likes = db.relationship("Track", secondary=likes_table, back_populates="liked_by", lazy="dynamic")
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Verify a password. Legacy werkzeug hashes are upgraded to argon2 on success; the caller commits."""
+        if not self.password_hash.startswith("$argon2"):
+            if not check_password_hash(self.password_hash, password):
+                return False
+            self.set_password(password)
+            return True
+        try:
+            password_hasher.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        if password_hasher.check_needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
 
 class Follow(db.Model):
     __tablename__ = "follows"
+    __table_args__ = (
+        db.UniqueConstraint("follower_id", "followed_id", name="uq_follows_pair"),
+        db.Index("ix_follows_followed", "followed_id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     follower_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     followed_id = db.Column(db.Integer, db.ForeignKey("users.id"))
@@ -63,8 +89,12 @@ class Follow(db.Model):
 
 class Track(db.Model):
     __tablename__ = "tracks"
+    __table_args__ = (
+        db.Index("ix_tracks_public_created", "is_public", "created_at"),
+        db.Index("ix_tracks_owner_created", "owner_id", "created_at"),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    owner_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     title = db.Column(db.String(255), nullable=False)
     description = db.Column(db.Text, default="")
     thumbnail = db.Column(db.String(200), nullable=True)
@@ -73,6 +103,10 @@ class Track(db.Model):
     original_filename = db.Column(db.String(255))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_public = db.Column(db.Boolean, default=True)
+    # "uploaded" until the transcode worker finishes, then "ready" (or "failed")
+    status = db.Column(db.String(20), default="uploaded", nullable=False)
+    # denormalised count of likes rows for this track, kept in step by like/unlike
+    likes_count = db.Column(db.Integer, default=0, nullable=False)
 
     # STORAGE OPTIONS:
     # If STORAGE_MODE == 'local' we store path strings.
@@ -80,24 +114,40 @@ class Track(db.Model):
     mp3_path = db.Column(db.String(1024), nullable=True)
     preview_path = db.Column(db.String(1024), nullable=True)
 
-    # If STORAGE_MODE == 'postgres' we may store binary fields:
-    original_file = db.Column(db.LargeBinary, nullable=True)
-    mp3_file = db.Column(db.LargeBinary, nullable=True)
-    preview_file = db.Column(db.LargeBinary, nullable=True)
+    # If STORAGE_MODE == 'postgres' we may store binary fields.
+    # Deferred so loading a Track never pulls the audio; streaming reads byte ranges.
+    original_file = db.deferred(db.Column(db.LargeBinary, nullable=True))
+    mp3_file = db.deferred(db.Column(db.LargeBinary, nullable=True))
+    preview_file = db.deferred(db.Column(db.LargeBinary, nullable=True))
 
     # For S3 we store keys:
     s3_key = db.Column(db.String(1024), nullable=True)
     s3_mp3_key = db.Column(db.String(1024), nullable=True)
     s3_preview_key = db.Column(db.String(1024), nullable=True)
 
-    comments = db.relationship("Comment", backref="track", lazy="dynamic")
-    favorites = db.relationship("Favorite", backref="track", lazy="dynamic")
+    comments = db.relationship("Comment", backref="track")
+    favorites = db.relationship("Favorite", backref="track")
 
     # likes relationship
     liked_by = db.relationship("User", secondary=likes_table, back_populates="likes", lazy="dynamic")
 
+# full-text search document for tracks; ix_tracks_fts indexes exactly this expression,
+# so queries must use it verbatim for postgres to pick the GIN index
+track_search_document = func.to_tsvector(
+    literal_column("'english'"),
+    func.coalesce(Track.title, literal_column("''", db.String))
+    + literal_column("' '", db.String)
+    + func.coalesce(Track.description, literal_column("''", db.String)),
+)
+Track.__table__.append_constraint(
+    db.Index("ix_tracks_fts", track_search_document, postgresql_using="gin").ddl_if(dialect="postgresql")
+)
+
 class Favorite(db.Model):
     __tablename__ = "favorites"
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "track_id", name="uq_favorites_pair"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     track_id = db.Column(db.Integer, db.ForeignKey("tracks.id"))
@@ -119,10 +169,13 @@ class Playlist(db.Model):
     title = db.Column(db.String(255), nullable=False)
     description = db.Column(db.Text, default="")
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    tracks = db.relationship("PlaylistTrack", backref="playlist", lazy="dynamic", cascade="all, delete-orphan")
+    tracks = db.relationship("PlaylistTrack", backref="playlist", cascade="all, delete-orphan")
 
 class PlaylistTrack(db.Model):
     __tablename__ = "playlist_tracks"
+    __table_args__ = (
+        db.UniqueConstraint("playlist_id", "track_id", name="uq_playlist_tracks_pair"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     playlist_id = db.Column(db.Integer, db.ForeignKey("playlists.id"))
     track_id = db.Column(db.Integer, db.ForeignKey("tracks.id"))
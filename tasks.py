@@ -0,0 +1,86 @@
+import os
+import logging
+from celery import Celery, Task
+from flask import current_app
+import ffmpeg
+from models import db, Track
+from utils import transcode_output_paths, store_track_variants
+
+logger = logging.getLogger(__name__)
+
+
+class FlaskTask(Task):
+    """Run every task inside the Flask app context so db.session works."""
+
+    def __call__(self, *args, **kwargs):
+        with self.app.flask_app.app_context():
+            return self.run(*args, **kwargs)
+
+
+celery = Celery(__name__, task_cls=FlaskTask)
+
+
+def celery_init_app(app):
+    """Bind the celery app to the Flask app. Start workers with `celery -A app.celery worker`."""
+    celery.conf.update(
+        broker_url=app.config["CELERY_BROKER_URL"],
+        task_ignore_result=True,
+        # a crashed worker should hand the upload to another one
+        task_acks_late=True,
+        worker_prefetch_multiplier=1,
+    )
+    celery.flask_app = app
+    app.extensions["celery"] = celery
+    return celery
+
+
+def _remove_files(*paths):
+    for p in paths:
+        if p and os.path.exists(p):
+            os.remove(p)
+
+
+@celery.task(bind=True, max_retries=3)
+def transcode_track(self, track_id, tmp_path, bitrate, preview_duration, preview_bitrate=None):
+    """
+    Transcode a spooled upload to mp3 plus a preview clip and mark the track ready.
+    The preview is mono at preview_bitrate (defaults to bitrate for jobs queued before it existed).
+    tmp_path is removed afterwards unless it is the stored original (local mode).
+    """
+    track = db.session.get(Track, track_id)
+    if track is None:
+        # upload was rolled back before we got to it
+        _remove_files(tmp_path)
+        return
+
+    mp3_path, preview_path = transcode_output_paths(track, tmp_path, current_app)
+    try:
+        probe = ffmpeg.probe(tmp_path)
+        track.duration = int(float(probe["format"].get("duration", 0)))
+        # decode once, split the audio and encode the full mp3 and preview in the same ffmpeg run
+        audio = ffmpeg.input(tmp_path).audio.filter_multi_output("asplit")
+        full = audio.stream(0).output(mp3_path, format="mp3", audio_bitrate=bitrate)
+        preview = audio.stream(1).filter("atrim", duration=int(preview_duration)).output(
+            preview_path, format="mp3", audio_bitrate=preview_bitrate or bitrate, ac=1
+        )
+        ffmpeg.merge_outputs(full, preview).overwrite_output().run(quiet=True)
+        store_track_variants(track, mp3_path, preview_path, current_app)
+        track.status = "ready"
+        db.session.commit()
+    except Exception as exc:
+        db.session.rollback()
+        _remove_files(mp3_path, preview_path)
+        if isinstance(exc, ffmpeg.Error) and exc.stderr:
+            # quiet=True captured ffmpeg's own diagnostics; the exception message only points at them
+            logger.error(
+                "ffmpeg failed for track %s (attempt %s): %s",
+                track_id, self.request.retries + 1, exc.stderr.decode(errors="replace"),
+            )
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exc, countdown=30)
+        logger.exception("Transcode failed for track %s", track_id)
+        track.status = "failed"
+        db.session.commit()
+
+    if tmp_path != track.file_path:
+        _remove_files(tmp_path)
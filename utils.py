@@ -2,47 +2,121 @@ import os
 import io
 import uuid
 import logging
+import unicodedata
 from pathlib import Path
-from pydub import AudioSegment
+from urllib.parse import quote
 import ffmpeg
 from PIL import Image
+from flask import Response, abort, redirect, request, send_file, stream_with_context
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 from werkzeug.utils import secure_filename
-from models import db, Track, User
+from sqlalchemy import func, literal_column
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import db, Track, User, track_search_document
 from sqlalchemy.exc import SQLAlchemyError
 import boto3
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
 
 logger = logging.getLogger(__name__)
 
+_s3 = None
+
+def get_s3(app):
+    """
+    Shared S3 client for this process. Building a client resolves credentials and
+    endpoints and opens fresh TLS connections, so it is done once and reused.
+    """
+    global _s3
+    if _s3 is None:
+        _s3 = boto3.session.Session().client(
+            "s3",
+            aws_access_key_id=app.config["AWS_ACCESS_KEY_ID"],
+            aws_secret_access_key=app.config["AWS_SECRET_ACCESS_KEY"],
+            region_name=app.config.get("S3_REGION"),
+            config=BotoConfig(max_pool_connections=50, retries={"mode": "adaptive"}),
+        )
+    return _s3
+
 def allowed_file(filename, allowed):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in allowed
 
+def search_tracks(query, q, rank=False):
+    """
+    Filter a Track query by a user search string. Postgres uses the tsvector GIN index
+    (websearch syntax, optionally ordered by relevance); other databases fall back to ILIKE.
+    """
+    if db.engine.dialect.name != "postgresql":
+        return query.filter(Track.title.ilike(f"%{q}%"))
+    tsquery = func.websearch_to_tsquery(literal_column("'english'"), q)
+    query = query.filter(track_search_document.op("@@")(tsquery))
+    if rank:
+        query = query.order_by(func.ts_rank(track_search_document, tsquery).desc())
+    return query
+
+def insert_ignore(table, index_elements, **values):
+    """
+    INSERT ... ON CONFLICT DO NOTHING for postgres (or sqlite in dev): one round trip,
+    and no race between checking for a row and inserting it. The statement's
+    rowcount is 0 when the row already existed.
+    """
+    insert = pg_insert if db.engine.dialect.name == "postgresql" else sqlite_insert
+    return insert(table).values(**values).on_conflict_do_nothing(index_elements=index_elements)
+
+# directories this process has already created, so uploads skip the stat/mkdir syscalls
+_ensured_dirs = set()
+
 def ensure_upload_folder(folder):
-    Path(folder).mkdir(parents=True, exist_ok=True)
+    folder = str(folder)
+    if folder not in _ensured_dirs:
+        Path(folder).mkdir(parents=True, exist_ok=True)
+        _ensured_dirs.add(folder)
+
+def save_upload(file_storage, path):
+    """
+    file_storage.save() into a folder made by ensure_upload_folder. If the folder has since
+    been removed (e.g. a tmp cleaner took the idle spool dir), forget it, recreate it and retry once.
+    """
+    try:
+        file_storage.save(str(path))
+    except FileNotFoundError:
+        folder = str(Path(path).parent)
+        _ensured_dirs.discard(folder)
+        ensure_upload_folder(folder)
+        file_storage.save(str(path))
 
 def handle_avatar_upload(user, file_storage, app):
     """Resize and save avatar. Depending on storage mode, save bytes to DB or a local file or S3."""
     img = Image.open(file_storage.stream)
+    # JPEG sources are downscaled by the decoder itself (DCT scaling), far cheaper than a full decode + resize
+    img.draft("RGB", app.config["AVATAR_MAX_SIZE"])
     img.thumbnail(app.config["AVATAR_MAX_SIZE"])
+    if img.mode in ("RGBA", "LA", "P"):
+        # flatten transparency onto white, JPEG has no alpha channel
+        img = img.convert("RGBA")
+        flat = Image.new("RGB", img.size, (255, 255, 255))
+        flat.paste(img, mask=img.getchannel("A"))
+        img = flat
+    else:
+        img = img.convert("RGB")
     out = io.BytesIO()
-    img.save(out, format="PNG")
+    # progressive JPEG encodes much faster than PNG deflate and is several times smaller for photos
+    img.save(out, format="JPEG", quality=85, optimize=True, progressive=True)
     out.seek(0)
-    filename = f"avatar_{user.id}_{uuid.uuid4().hex}.png"
+    filename = f"avatar_{user.id}_{uuid.uuid4().hex}.jpg"
     if app.config["STORAGE_MODE"] == "postgres":
         user.avatar_data = out.getvalue()
         user.avatar_filename = filename
     elif app.config["STORAGE_MODE"] == "s3":
-        s3 = boto3.client(
-            "s3",
-            aws_access_key_id=app.config["AWS_ACCESS_KEY_ID"],
-            aws_secret_access_key=app.config["AWS_SECRET_ACCESS_KEY"],
-            region_name=app.config.get("S3_REGION")
-        )
+        s3 = get_s3(app)
         key = f"avatars/{filename}"
-        s3.put_object(Bucket=app.config["S3_BUCKET"], Key=key, Body=out.getvalue(), ContentType="image/png")
+        s3.put_object(Bucket=app.config["S3_BUCKET"], Key=key, Body=out.getvalue(), ContentType="image/jpeg")
         user.avatar_filename = key
     else:
         out_path = Path(app.config["UPLOAD_FOLDER"]) / "avatars"
-        out_path.mkdir(parents=True, exist_ok=True)
+        ensure_upload_folder(out_path)
         file_path = out_path / filename
         with open(file_path, "wb") as fh:
             fh.write(out.getvalue())
@@ -51,68 +125,129 @@ def handle_avatar_upload(user, file_storage, app):
 
 def process_track_upload(track, file_storage, app):
     """
-    Save original and create MP3 transcoded version and preview clip.
-    Behavior depends on app.config['STORAGE_MODE'] (local, s3, postgres).
+    Save the original upload and spool it to disk for the transcode worker
+    (see tasks.transcode_track). Behavior depends on app.config['STORAGE_MODE']
+    (local, s3, postgres). Returns the path the worker should transcode from.
     """
-    # load into AudioSegment via pydub (which uses ffmpeg)
     filename = secure_filename(file_storage.filename)
     ext = filename.rsplit(".", 1)[1].lower()
-    orig_bytes = file_storage.read()
-    # determine duration via pydub
-    audio = AudioSegment.from_file(io.BytesIO(orig_bytes), format=ext)
-    duration_ms = len(audio)
-    track.duration = int(duration_ms / 1000)
     track.original_filename = filename
-    # create mp3 (transcode)
-    mp3_io = io.BytesIO()
-    audio.export(mp3_io, format="mp3", bitrate=app.config["TRANSCODE_BITRATE"])
-    mp3_io.seek(0)
-    # create preview (clip)
-    preview_len = int(app.config.get("PREVIEW_DURATION", 30)) * 1000
-    preview_seg = audio[:preview_len]
-    preview_io = io.BytesIO()
-    preview_seg.export(preview_io, format="mp3", bitrate=app.config["TRANSCODE_BITRATE"])
-    preview_io.seek(0)
+    track.mime_type = "audio/" + ext
+    track.status = "uploaded"
 
+    # one id per upload, shared by every file it produces (<uid>_orig/_stream/_preview)
+    uid = uuid.uuid4().hex
+    mode = app.config["STORAGE_MODE"]
+    if mode == "local":
+        # the worker reads the stored original directly, no extra copy
+        base = Path(app.config["UPLOAD_FOLDER"]) / str(track.owner_id)
+        ensure_upload_folder(base)
+        orig_path = base / f"{uid}_orig.{ext}"
+        save_upload(file_storage, orig_path)
+        track.file_path = str(orig_path)
+        tmp_path = orig_path
+    else:
+        spool = Path(app.config["TRANSCODE_SPOOL_FOLDER"])
+        ensure_upload_folder(spool)
+        tmp_path = spool / f"{uid}_orig.{ext}"
+        save_upload(file_storage, tmp_path)
+        try:
+            if mode == "postgres":
+                track.original_file = tmp_path.read_bytes()
+            else:
+                s3 = get_s3(app)
+                key_base = f"tracks/{track.owner_id}/{uid}"
+                # upload_file streams from disk and switches to concurrent multipart uploads for big files
+                s3.upload_file(str(tmp_path), app.config["S3_BUCKET"], key_base + "/original." + ext, ExtraArgs={"ContentType": "audio/" + ext})
+                track.s3_key = key_base + "/original." + ext
+        except Exception:
+            discard_spooled_upload(tmp_path, app)
+            raise
+    return str(tmp_path)
+
+def discard_spooled_upload(tmp_path, app):
+    """Remove a spooled upload. In local mode the spooled file is the stored original, so it is kept."""
+    if app.config["STORAGE_MODE"] != "local" and tmp_path and os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+def transcode_output_paths(track, tmp_path, app):
+    """Where the worker should write the mp3 and preview for a track (same uid as the original)."""
+    uid = Path(tmp_path).name.split("_", 1)[0]
+    if app.config["STORAGE_MODE"] == "local":
+        # write straight into the owner's folder next to the original
+        base = Path(track.file_path).parent
+    else:
+        base = Path(app.config["TRANSCODE_SPOOL_FOLDER"])
+    return (
+        str(base / f"{uid}_stream.mp3"),
+        str(base / f"{uid}_preview.mp3"),
+    )
+
+def store_track_variants(track, mp3_path, preview_path, app):
+    """Move the worker's mp3 and preview outputs into storage."""
     mode = app.config["STORAGE_MODE"]
     if mode == "postgres":
-        track.original_file = orig_bytes
-        track.mp3_file = mp3_io.getvalue()
-        track.preview_file = preview_io.getvalue()
+        track.mp3_file = Path(mp3_path).read_bytes()
+        track.preview_file = Path(preview_path).read_bytes()
+        os.remove(mp3_path)
+        os.remove(preview_path)
     elif mode == "s3":
-        s3 = boto3.client(
-            "s3",
-            aws_access_key_id=app.config["AWS_ACCESS_KEY_ID"],
-            aws_secret_access_key=app.config["AWS_SECRET_ACCESS_KEY"],
-            region_name=app.config.get("S3_REGION")
-        )
-        key_base = f"tracks/{track.owner_id}/{uuid.uuid4().hex}"
-        s3.put_object(Bucket=app.config["S3_BUCKET"], Key=key_base + "/original." + ext, Body=orig_bytes, ContentType="audio/" + ext)
-        s3.put_object(Bucket=app.config["S3_BUCKET"], Key=key_base + "/stream.mp3", Body=mp3_io.getvalue(), ContentType="audio/mpeg")
-        s3.put_object(Bucket=app.config["S3_BUCKET"], Key=key_base + "/preview.mp3", Body=preview_io.getvalue(), ContentType="audio/mpeg")
-        track.s3_key = key_base + "/original." + ext
+        s3 = get_s3(app)
+        key_base = track.s3_key.rsplit("/", 1)[0]
+        s3.upload_file(mp3_path, app.config["S3_BUCKET"], key_base + "/stream.mp3", ExtraArgs={"ContentType": "audio/mpeg"})
+        s3.upload_file(preview_path, app.config["S3_BUCKET"], key_base + "/preview.mp3", ExtraArgs={"ContentType": "audio/mpeg"})
         track.s3_mp3_key = key_base + "/stream.mp3"
         track.s3_preview_key = key_base + "/preview.mp3"
+        os.remove(mp3_path)
+        os.remove(preview_path)
     else:
-        # local filesystem
-        base = Path(app.config["UPLOAD_FOLDER"]) / str(track.owner_id)
-        base.mkdir(parents=True, exist_ok=True)
-        orig_path = base / f"{uuid.uuid4().hex}_orig.{ext}"
-        with open(orig_path, "wb") as fh:
-            fh.write(orig_bytes)
-        mp3_path = base / f"{uuid.uuid4().hex}_stream.mp3"
-        with open(mp3_path, "wb") as fh:
-            fh.write(mp3_io.getvalue())
-        preview_path = base / f"{uuid.uuid4().hex}_preview.mp3"
-        with open(preview_path, "wb") as fh:
-            fh.write(preview_io.getvalue())
-        track.file_path = str(orig_path)
-        track.mp3_path = str(mp3_path)
-        track.preview_path = str(preview_path)
+        track.mp3_path = mp3_path
+        track.preview_path = preview_path
     # set mime
     track.mime_type = "audio/mpeg"
-    db.session.add(track)
-    db.session.flush()
+
+def _disposition_filenames(download_name):
+    """Content-Disposition filename params, with an ASCII fallback plus filename* for non-ASCII names (as send_file does)."""
+    try:
+        download_name.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", download_name).encode("ascii", "ignore").decode("ascii")
+        return {"filename": simple, "filename*": "UTF-8''" + quote(download_name, safe="!#$&+-.^_`|~")}
+    return {"filename": download_name}
+
+def _blob_range_response(track, column, mimetype, download_name, app):
+    """
+    Serve a LargeBinary column (postgres storage mode) honouring the Range header.
+    Only the requested bytes are fetched, chunk by chunk with substr(), so the blob
+    is never loaded whole into the worker. Returns None if the column is empty.
+    """
+    track_id = track.id
+    length = db.session.query(func.length(column)).filter(Track.id == track_id).scalar()
+    if not length:
+        return None
+    start, stop = 0, length
+    if request.range is not None:
+        bounds = request.range.range_for_length(length)
+        if bounds is None:
+            raise RequestedRangeNotSatisfiable(length=length)
+        start, stop = bounds
+    chunk_size = app.config["STREAM_CHUNK_SIZE"]
+
+    def generate():
+        for offset in range(start, stop, chunk_size):
+            size = min(chunk_size, stop - offset)
+            yield db.session.query(
+                func.substr(column, offset + 1, size, type_=db.LargeBinary)
+            ).filter(Track.id == track_id).scalar()
+
+    resp = Response(stream_with_context(generate()), mimetype=mimetype, direct_passthrough=True)
+    resp.headers["Accept-Ranges"] = "bytes"
+    resp.headers.set("Content-Disposition", "inline", **_disposition_filenames(download_name))
+    resp.content_length = stop - start
+    if request.range is not None:
+        resp.status_code = 206
+        resp.content_range = ContentRange("bytes", start, stop, length)
+    return resp
 
 def get_file_stream_response(track, variant="mp3", app=None):
     """
@@ -120,21 +255,22 @@ def get_file_stream_response(track, variant="mp3", app=None):
     Returns a Flask response streaming the appropriate file.
     """
     mode = app.config["STORAGE_MODE"]
+    if track.status != "ready":
+        # still transcoding (or failed): only the original exists
+        variant = "original"
     if mode == "postgres":
-        if variant == "mp3" and track.mp3_file:
-            return send_file(io.BytesIO(track.mp3_file), mimetype="audio/mpeg", as_attachment=False, download_name=f"{track.title}.mp3")
-        elif variant == "preview" and track.preview_file:
-            return send_file(io.BytesIO(track.preview_file), mimetype="audio/mpeg", as_attachment=False, download_name=f"{track.title}_preview.mp3")
-        elif track.original_file:
-            # try detect original mime
-            return send_file(io.BytesIO(track.original_file), mimetype=track.mime_type or "application/octet-stream", as_attachment=False, download_name=track.original_filename)
+        resp = None
+        if variant == "mp3":
+            resp = _blob_range_response(track, Track.mp3_file, "audio/mpeg", f"{track.title}.mp3", app)
+        elif variant == "preview":
+            resp = _blob_range_response(track, Track.preview_file, "audio/mpeg", f"{track.title}_preview.mp3", app)
+        if resp is None:
+            resp = _blob_range_response(track, Track.original_file, track.mime_type or "application/octet-stream", track.original_filename, app)
+        if resp is None:
+            abort(404)
+        return resp
     elif mode == "s3":
-        s3 = boto3.client(
-            "s3",
-            aws_access_key_id=app.config["AWS_ACCESS_KEY_ID"],
-            aws_secret_access_key=app.config["AWS_SECRET_ACCESS_KEY"],
-            region_name=app.config.get("S3_REGION")
-        )
+        s3 = get_s3(app)
         key = None
         if variant == "mp3":
             key = track.s3_mp3_key or track.s3_key
@@ -144,10 +280,43 @@ def get_file_stream_response(track, variant="mp3", app=None):
             key = track.s3_key
         if not key:
             abort(404)
-        obj = s3.get_object(Bucket=app.config["S3_BUCKET"], Key=key)
-        body = obj["Body"].read()
-        content_type = obj.get("ContentType", "audio/mpeg")
-        return send_file(io.BytesIO(body), mimetype=content_type, as_attachment=False, download_name=track.title)
+        if app.config["S3_PRESIGNED_URLS"]:
+            # the browser fetches (and seeks) straight from S3; the bucket needs CORS for our origin
+            url = s3.generate_presigned_url(
+                "get_object",
+                Params={
+                    "Bucket": app.config["S3_BUCKET"],
+                    "Key": key,
+                    "ResponseContentDisposition": "inline; filename*=UTF-8''" + quote(track.title),
+                },
+                ExpiresIn=app.config["S3_PRESIGN_EXPIRES"],
+            )
+            return redirect(url)
+        params = {"Bucket": app.config["S3_BUCKET"], "Key": key}
+        if request.range is not None:
+            # let S3 do the slicing, we only relay the requested bytes
+            params["Range"] = request.headers["Range"]
+        try:
+            obj = s3.get_object(**params)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "InvalidRange":
+                abort(416)
+            raise
+        body = obj["Body"]
+        resp = Response(
+            body.iter_chunks(app.config["STREAM_CHUNK_SIZE"]),
+            mimetype=obj.get("ContentType", "audio/mpeg"),
+            direct_passthrough=True,
+        )
+        # a listener that skips or closes the tab stops the stream early; release the
+        # pooled S3 connection instead of leaving it half-read until garbage collection
+        resp.call_on_close(body.close)
+        resp.headers["Accept-Ranges"] = "bytes"
+        resp.content_length = obj["ContentLength"]
+        if obj.get("ContentRange"):
+            resp.status_code = 206
+            resp.headers["Content-Range"] = obj["ContentRange"]
+        return resp
     else:
         # local paths
         path = None
@@ -159,7 +328,14 @@ def get_file_stream_response(track, variant="mp3", app=None):
             path = track.file_path
         if not path or not os.path.exists(path):
             abort(404)
-        return send_file(path, mimetype=track.mime_type or "audio/mpeg", as_attachment=False, download_name=os.path.basename(path))
+        if app.config["X_ACCEL_REDIRECT"]:
+            # nginx sends the file itself (sendfile(2), Range handled by nginx); the worker is freed at once
+            rel = os.path.relpath(path, app.config["UPLOAD_FOLDER"]).replace(os.sep, "/")
+            resp = Response(mimetype=track.mime_type or "audio/mpeg")
+            resp.headers["X-Accel-Redirect"] = app.config["X_ACCEL_PREFIX"] + quote(rel)
+            return resp
+        # conditional=True answers Range requests with 206 straight from the file
+        return send_file(path, mimetype=track.mime_type or "audio/mpeg", as_attachment=False, download_name=os.path.basename(path), conditional=True)
 
 def storage_delete(track, app):
     """Remove files from storage when rollback/failed upload cleanup needed."""
@@ -170,15 +346,21 @@ def storage_delete(track, app):
                 if p and os.path.exists(p):
                     os.remove(p)
         elif mode == "s3":
-            s3 = boto3.client(
-                "s3",
-                aws_access_key_id=app.config["AWS_ACCESS_KEY_ID"],
-                aws_secret_access_key=app.config["AWS_SECRET_ACCESS_KEY"],
-                region_name=app.config.get("S3_REGION")
-            )
+            s3 = get_s3(app)
             keys = [k for k in (track.s3_key, track.s3_mp3_key, track.s3_preview_key) if k]
-            for k in keys:
-                s3.delete_object(Bucket=app.config["S3_BUCKET"], Key=k)
+            if keys:
+                # one DeleteObjects request instead of a round trip per key
+                try:
+                    resp = s3.delete_objects(
+                        Bucket=app.config["S3_BUCKET"],
+                        Delete={"Objects": [{"Key": k} for k in keys], "Quiet": True},
+                    )
+                except ClientError as e:
+                    logger.exception("Error deleting S3 objects %s: %s", keys, e)
+                else:
+                    # quiet mode only reports the keys that failed
+                    for err in resp.get("Errors", []):
+                        logger.error("Could not delete S3 object %s: %s", err.get("Key"), err.get("Message"))
         else:
             # postgres: null out binary fields
             track.original_file = None